@@ -4,32 +4,65 @@
 ## SPDX-License-Identifier: Apache-2.0
 
 import re
+import subprocess
 import sys
 import os
-from glob import glob
 import shutil
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from common import *
 
 ISPC_VERSION = '1.23.0'
 TBB_VERSION  = '2021.11.0'
 
-def check_symbols(filename, label, max_version):
-  with os.popen("nm \"%s\" | tr ' ' '\n' | grep @@%s_" % (filename, label)) as out:
-    for line in out:
-      symbol = line.strip()
-      _, version = symbol.split('@@')
-      _, version = version.split('_')
-      version = [int(v) for v in version.split('.')]
-      if version > list(max_version):
-        raise Exception('problematic symbol %s in %s' % (symbol, os.path.basename(filename)))
+# Maximum allowed versions of the versioned symbols in Linux binaries
+MAX_SYMBOL_VERSIONS = {'GLIBC'   : (2, 28, 0),
+                       'GLIBCXX' : (3, 4, 22),
+                       'CXXABI'  : (1, 3, 11)}
+
+SYMBOL_VERSION_RE = re.compile(r'@@?(GLIBC|GLIBCXX|CXXABI)_([0-9.]+)')
+PACKAGE_EXT_RE = re.compile(r'\.(tar(\..*)?|zip)$')
 
 def check_symbols_linux(filename):
   print('Checking symbols:', filename)
-  check_symbols(filename, 'GLIBC',   (2, 28, 0))
-  check_symbols(filename, 'GLIBCXX', (3, 4, 22))
-  check_symbols(filename, 'CXXABI',  (1, 3, 11))
+  # Scan the symbol table only once for all labels
+  # Files rejected by nm (e.g. not ELF) are skipped, nm reports them on stderr
+  result = subprocess.run(['nm', '--no-demangle', filename], stdout=subprocess.PIPE, text=True)
+  if result.returncode != 0:
+    return
+  for line in result.stdout.splitlines():
+    match = SYMBOL_VERSION_RE.search(line)
+    if match:
+      label, version = match.groups()
+      version = tuple(int(v) for v in version.split('.'))
+      if version > MAX_SYMBOL_VERSIONS[label]:
+        symbol = line.split()[-1]
+        raise Exception('problematic symbol %s in %s' % (symbol, os.path.basename(filename)))
+
+# Returns the regular files (excluding symlinks) in a directory whose names match
+# a predicate, with a single directory scan
+def list_files(dir, predicate=lambda name: True):
+  if not os.path.isdir(dir):
+    return []
+  with os.scandir(dir) as entries:
+    return [entry.path for entry in entries if predicate(entry.name) and entry.is_file(follow_symlinks=False)]
+
+# Returns whether a package member is a binary (executable or shared library)
+def is_package_binary(name):
+  parts = [part for part in name.split('/') if part not in {'', '.'}]
+  if len(parts) != 3:
+    return False
+  subdir, basename = parts[1:]
+  if subdir == 'bin':
+    return True
+  elif subdir == 'lib':
+    if OS == 'linux':
+      return '.so' in basename
+    elif OS == 'macos':
+      return basename.endswith('.dylib')
+  return False
 
 # Parse the arguments
 compilers = {'windows' : ['msvc17', 'msvc16-icc21', 'msvc16', 'msvc15', 'clang', 'icx'],
@@ -44,6 +77,7 @@ parser.add_argument('--install_dir', '-I', type=str, help='install directory')
 parser.add_argument('--compiler', type=str, choices=(['default'] + compilers[OS]), default='default')
 parser.add_argument('--config', type=str, choices=['Debug', 'Release', 'RelWithDebInfo'], default='Release')
 parser.add_argument('--full', action='store_true', help='build with full device support')
+parser.add_argument('--clean', action='store_true', help='always build from a clean build directory')
 parser.add_argument('--wrapper', type=str, help='wrap build command')
 parser.add_argument('-D', dest='cmake_vars', type=str, action='append', help='create or update a CMake cache entry')
 cfg = parser.parse_args()
@@ -61,29 +95,29 @@ else:
 if cfg.compiler == 'default' and cfg.full:
   cfg.compiler = 'clang'
 
-# Create a clean build directory
-if os.path.isdir(cfg.build_dir):
-  shutil.rmtree(cfg.build_dir)
-os.mkdir(cfg.build_dir)
-os.chdir(cfg.build_dir)
+# Build in parallel using all cores
+num_jobs = os.cpu_count() or 2
 
 # Configure
 msbuild = False
-config_cmd = 'cmake -L'
+ninja = False
+config_cmd = ['cmake', '-L']
 
 if OS == 'windows':
   if cfg.compiler == 'clang':
     cc  = 'clang'
     cxx = 'clang++'
-    config_cmd += ' -G Ninja'
-    config_cmd += f' -D CMAKE_C_COMPILER:FILEPATH="{cc}"'
-    config_cmd += f' -D CMAKE_CXX_COMPILER:FILEPATH="{cxx}"'
+    ninja = True
+    config_cmd += ['-G', 'Ninja']
+    config_cmd += ['-D', f'CMAKE_C_COMPILER:FILEPATH={cc}']
+    config_cmd += ['-D', f'CMAKE_CXX_COMPILER:FILEPATH={cxx}']
   elif cfg.compiler == 'icx':
     cc  = 'icx'
     cxx = 'icx'
-    config_cmd += ' -G Ninja'
-    config_cmd += f' -D CMAKE_C_COMPILER:FILEPATH="{cc}"'
-    config_cmd += f' -D CMAKE_CXX_COMPILER:FILEPATH="{cxx}"'
+    ninja = True
+    config_cmd += ['-G', 'Ninja']
+    config_cmd += ['-D', f'CMAKE_C_COMPILER:FILEPATH={cc}']
+    config_cmd += ['-D', f'CMAKE_CXX_COMPILER:FILEPATH={cxx}']
   else:
     msbuild = True
     if cfg.compiler == 'default':
@@ -91,15 +125,16 @@ if OS == 'windows':
     for compiler in cfg.compiler.split('-'):
       if compiler.startswith('msvc'):
         msvc_arch = {'x86_64': 'x64', 'arm64': 'ARM64'}[ARCH]
-        config_cmd += {'msvc15' :  ' -G "Visual Studio 15 2017 Win64"',
-                       'msvc16' : f' -G "Visual Studio 16 2019" -A {msvc_arch}',
-                       'msvc17' : f' -G "Visual Studio 17 2022" -A {msvc_arch}'}[compiler]
+        config_cmd += {'msvc15' : ['-G', 'Visual Studio 15 2017 Win64'],
+                       'msvc16' : ['-G', 'Visual Studio 16 2019', '-A', msvc_arch],
+                       'msvc17' : ['-G', 'Visual Studio 17 2022', '-A', msvc_arch]}[compiler]
       elif compiler.startswith('icc'):
         icc_version = {'18' : '18.0', '19' : '19.0', '20' : '19.1', '21' : '19.2'}[compiler[3:]]
-        config_cmd += f' -T "Intel C++ Compiler {icc_version}"'
+        config_cmd += ['-T', f'Intel C++ Compiler {icc_version}']
 else:
-  if OS == 'linux':
-    config_cmd += ' -G Ninja'
+  if OS == 'linux' or shutil.which('ninja'):
+    ninja = True
+    config_cmd += ['-G', 'Ninja']
   if cfg.compiler != 'default':
     cc = cfg.compiler
     cxx = {'gcc' : 'g++', 'clang' : 'clang++', 'icx' : 'icpx', 'icc' : 'icpc'}[cc]
@@ -108,14 +143,35 @@ else:
       if icc_dir:
         cc  = os.path.join(icc_dir, cc)
         cxx = os.path.join(icc_dir, cxx)
-    config_cmd += f' -D CMAKE_C_COMPILER:FILEPATH="{cc}"'
-    config_cmd += f' -D CMAKE_CXX_COMPILER:FILEPATH="{cxx}"'
+    config_cmd += ['-D', f'CMAKE_C_COMPILER:FILEPATH={cc}']
+    config_cmd += ['-D', f'CMAKE_CXX_COMPILER:FILEPATH={cxx}']
+
+# Use a compiler cache if available (not supported by MSBuild)
+if not msbuild:
+  compiler_launcher = shutil.which('sccache') or shutil.which('ccache')
+  if compiler_launcher:
+    if os.path.splitext(os.path.basename(compiler_launcher))[0] == 'ccache':
+      os.environ.setdefault('CCACHE_DIR', os.path.join(root_dir, '.ccache'))
+    config_cmd += ['-D', f'CMAKE_C_COMPILER_LAUNCHER:FILEPATH={compiler_launcher}']
+    config_cmd += ['-D', f'CMAKE_CXX_COMPILER_LAUNCHER:FILEPATH={compiler_launcher}']
 
 # Set up the dependencies
 deps_dir = os.path.join(root_dir, 'deps')
 if not os.path.isdir(deps_dir):
   os.makedirs(deps_dir)
 
+# Downloaded packages are kept in a cache to avoid downloading them again
+# when the extracted dependencies are missing (e.g. on fresh CI runners)
+cache_dir = os.path.join(deps_dir, 'cache')
+if not os.path.isdir(cache_dir):
+  os.makedirs(cache_dir)
+
+# Downloads and extracts a dependency package, returning the archive path
+def fetch_dep(url, output_dir):
+  filename = download_file(url, cache_dir)
+  extract_package(filename, output_dir)
+  return filename
+
 # Set up TBB
 tbb_release = f'oneapi-tbb-{TBB_VERSION}-'
 tbb_release += {'windows' : 'win', 'linux' : 'lin', 'macos' : 'mac'}[OS]
@@ -123,38 +179,17 @@ tbb_dir = os.path.join(deps_dir, tbb_release)
 if OS == 'macos':
   tbb_dir += f'.{ARCH}'
 tbb_root = os.path.join(tbb_dir, f'oneapi-tbb-{TBB_VERSION}')
-if not os.path.isdir(tbb_dir):
-  if OS != 'macos' and ARCH != 'arm64':
-    # Download and extract TBB
-    tbb_url = f'https://github.com/oneapi-src/oneTBB/releases/download/v{TBB_VERSION}/{tbb_release}'
-    tbb_url += '.zip' if OS == 'windows' else '.tgz'
-    tbb_filename = download_file(tbb_url, deps_dir)
-    extract_package(tbb_filename, tbb_dir)
-    os.remove(tbb_filename)
-  else:
-    # Download TBB source
-    tbb_url = f'https://github.com/oneapi-src/oneTBB/archive/refs/tags/v{TBB_VERSION}.tar.gz'
-    tbb_filename = download_file(tbb_url, deps_dir)
-    extract_package(tbb_filename, deps_dir)
-    os.remove(tbb_filename)
-
-    # Build TBB
-    tbb_src_dir = os.path.join(deps_dir, f'oneTBB-{TBB_VERSION}')
-    tbb_build_dir = os.path.join(tbb_src_dir, 'build')
-    os.mkdir(tbb_build_dir)
-    os.chdir(tbb_build_dir)
-    tbb_config_cmd = config_cmd + f' -D CMAKE_BUILD_TYPE=Release -D TBB_TEST=OFF -D CMAKE_INSTALL_PREFIX={tbb_root} ..'
-    if OS == 'macos':
-      min_macos_version = {'x86_64' : '10.11', 'arm64' : '11.0'}[ARCH]
-      tbb_config_cmd += f' -D CMAKE_OSX_DEPLOYMENT_TARGET={min_macos_version}'
-    run(tbb_config_cmd)
-    if msbuild:
-      run('cmake --build . --config Release --target INSTALL')
-    else:
-      run('cmake --build . --target install')
-    os.chdir(cfg.build_dir)
-    shutil.rmtree(tbb_src_dir)
-config_cmd += f' -D TBB_ROOT="{tbb_root}"'
+tbb_missing = not os.path.isdir(tbb_dir)
+tbb_binary = OS != 'macos' and ARCH != 'arm64'
+if tbb_binary:
+  # Download TBB binaries
+  tbb_url = f'https://github.com/oneapi-src/oneTBB/releases/download/v{TBB_VERSION}/{tbb_release}'
+  tbb_url += '.zip' if OS == 'windows' else '.tgz'
+  tbb_output_dir = tbb_dir
+else:
+  # Download TBB source
+  tbb_url = f'https://github.com/oneapi-src/oneTBB/archive/refs/tags/v{TBB_VERSION}.tar.gz'
+  tbb_output_dir = deps_dir
 
 # Set up ISPC
 ispc_release = f'ispc-v{ISPC_VERSION}-'
@@ -162,77 +197,118 @@ ispc_release += {'windows' : 'windows', 'linux' : 'linux', 'macos' : 'macOS.univ
 if OS == 'linux' and ARCH == 'arm64':
   ispc_release += '.aarch64'
 ispc_dir = os.path.join(deps_dir, ispc_release)
-if not os.path.isdir(ispc_dir):
-  # Download and extract ISPC
-  ispc_url = f'https://github.com/ispc/ispc/releases/download/v{ISPC_VERSION}/{ispc_release}'
-  ispc_url += '.zip' if OS == 'windows' else '.tar.gz'
-  ispc_filename = download_file(ispc_url, deps_dir)
-  extract_package(ispc_filename, ispc_dir)
-  os.remove(ispc_filename)
+ispc_url = f'https://github.com/ispc/ispc/releases/download/v{ISPC_VERSION}/{ispc_release}'
+ispc_url += '.zip' if OS == 'windows' else '.tar.gz'
+
+# Download and extract the missing dependencies concurrently
+with ThreadPoolExecutor(max_workers=2) as executor:
+  dep_futures = []
+  if tbb_missing:
+    dep_futures.append(executor.submit(fetch_dep, tbb_url, tbb_output_dir))
+  if not os.path.isdir(ispc_dir):
+    dep_futures.append(executor.submit(fetch_dep, ispc_url, ispc_dir))
+  for future in dep_futures:
+    future.result()
+
+if tbb_missing and not tbb_binary:
+  # Build TBB
+  tbb_src_dir = os.path.join(deps_dir, f'oneTBB-{TBB_VERSION}')
+  tbb_build_dir = os.path.join(tbb_src_dir, 'build')
+  os.mkdir(tbb_build_dir)
+  tbb_config_cmd = config_cmd + ['-D', 'CMAKE_BUILD_TYPE=Release', '-D', 'TBB_TEST=OFF', '-D', f'CMAKE_INSTALL_PREFIX={tbb_root}', '..']
+  if OS == 'macos':
+    min_macos_version = {'x86_64' : '10.11', 'arm64' : '11.0'}[ARCH]
+    tbb_config_cmd += ['-D', f'CMAKE_OSX_DEPLOYMENT_TARGET={min_macos_version}']
+  run(tbb_config_cmd, cwd=tbb_build_dir)
+  if msbuild:
+    run(['cmake', '--build', '.', '--config', 'Release', '--target', 'INSTALL', '--parallel', str(num_jobs)], cwd=tbb_build_dir)
+  else:
+    run(['cmake', '--build', '.', '--target', 'install', '--parallel', str(num_jobs)], cwd=tbb_build_dir)
+  shutil.rmtree(tbb_src_dir)
+config_cmd += ['-D', f'TBB_ROOT={tbb_root}']
+
 ispc_executable = os.path.join(ispc_dir, 'bin', 'ispc')
 if OS == 'windows':
   ispc_executable += '.exe'
-config_cmd += f' -D ISPC_EXECUTABLE="{ispc_executable}"'
+config_cmd += ['-D', f'ISPC_EXECUTABLE={ispc_executable}']
 
-config_cmd += f' -D CMAKE_BUILD_TYPE={cfg.config}'
+config_cmd += ['-D', f'CMAKE_BUILD_TYPE={cfg.config}']
 
 if cfg.full:
   if OS != 'macos' and ARCH != 'arm64':
-    config_cmd += ' -D OIDN_DEVICE_CPU=ON -D OIDN_DEVICE_SYCL=ON -D OIDN_DEVICE_CUDA=ON -D OIDN_DEVICE_HIP=ON'
+    config_cmd += ['-D', 'OIDN_DEVICE_CPU=ON', '-D', 'OIDN_DEVICE_SYCL=ON', '-D', 'OIDN_DEVICE_CUDA=ON', '-D', 'OIDN_DEVICE_HIP=ON']
   elif OS == 'macos' and ARCH == 'arm64':
-    config_cmd += ' -D OIDN_DEVICE_CPU=ON -D OIDN_DEVICE_METAL=ON'
+    config_cmd += ['-D', 'OIDN_DEVICE_CPU=ON', '-D', 'OIDN_DEVICE_METAL=ON']
 
-config_cmd += ' -D OIDN_WARN_AS_ERRORS=ON'
+config_cmd += ['-D', 'OIDN_WARN_AS_ERRORS=ON']
 
 if cfg.target in {'install', 'package'}:
-  config_cmd += ' -D OIDN_INSTALL_DEPENDENCIES=ON'
+  config_cmd += ['-D', 'OIDN_INSTALL_DEPENDENCIES=ON']
 
 if cfg.target == 'package':
-  config_cmd += ' -D OIDN_ZIP_MODE=ON'
+  config_cmd += ['-D', 'OIDN_ZIP_MODE=ON']
 
 if cfg.target == 'install':
-  config_cmd += f' -D CMAKE_INSTALL_PREFIX={cfg.install_dir}'
+  config_cmd += ['-D', f'CMAKE_INSTALL_PREFIX={cfg.install_dir}']
 
 if cfg.cmake_vars:
   for var in cfg.cmake_vars:
-    config_cmd += f' -D {var}'
-
-config_cmd += ' ..'
-
-run(config_cmd)
+    config_cmd += ['-D', var]
+
+config_cmd += ['..']
+
+# Reuse the build directory if it was configured with the same command and
+# toolchain environment (CMake reads CC/CXX only on the first configure) for an
+# incremental build, otherwise create a clean build directory
+# Packages are always built from scratch
+config = {'config_cmd' : config_cmd,
+          'CC'  : os.environ.get('CC'),
+          'CXX' : os.environ.get('CXX')}
+config_filename = os.path.join(cfg.build_dir, '.build_config.json')
+prev_config = None
+if not cfg.clean and cfg.target != 'package' and os.path.isfile(os.path.join(cfg.build_dir, 'CMakeCache.txt')):
+  try:
+    with open(config_filename) as f:
+      prev_config = json.load(f)
+  except (OSError, ValueError):
+    pass
+
+if prev_config == config:
+  os.chdir(cfg.build_dir)
+else:
+  if os.path.isdir(cfg.build_dir):
+    shutil.rmtree(cfg.build_dir)
+  os.mkdir(cfg.build_dir)
+  os.chdir(cfg.build_dir)
+  run(config_cmd)
+  with open(config_filename, 'w') as f:
+    json.dump(config, f)
 
 # Build
-build_cmd  = 'cmake --build .'
+build_cmd = ['cmake', '--build', '.', '--parallel', str(num_jobs)]
 
 if msbuild:
   cmake_target = {'all' : 'ALL_BUILD', 'install' : 'INSTALL', 'package' : 'PACKAGE'}[cfg.target]
-  build_cmd += f' --config {cfg.config} --target {cmake_target}'
+  build_cmd += ['--config', cfg.config, '--target', cmake_target]
 else:
-  build_cmd += f' --target {cfg.target}'
-  if OS == 'macos':
-    build_cmd += ' -- VERBOSE=1' # Make
+  build_cmd += ['--target', cfg.target]
+  if ninja:
+    build_cmd += ['--', '-v'] # Ninja
   else:
-    build_cmd += ' -- -v' # Ninja
+    build_cmd += ['--', 'VERBOSE=1'] # Make
 
 if cfg.wrapper:
-  build_cmd = cfg.wrapper + ' ' + build_cmd
+  build_cmd = split_command(cfg.wrapper) + build_cmd
 run(build_cmd)
 
 if cfg.target == 'package':
-  # Extract the package
-  package_filename = [f for f in glob(os.path.join(cfg.build_dir, 'oidn-*')) if os.path.isfile(f)][0]
-  package_dir = re.sub(r'\.(tar(\..*)?|zip)$', '', package_filename)
+  # Extract only the binaries from the package, which are checked and signed
+  package_filename = list_files(cfg.build_dir, lambda name: name.startswith('oidn-'))[0]
+  package_dir = PACKAGE_EXT_RE.sub('', package_filename)
   if os.path.isdir(package_dir):
     shutil.rmtree(package_dir)
-  extract_package(package_filename, cfg.build_dir)
-
-  # Get the list of binaries
-  binaries = glob(os.path.join(package_dir, 'bin', '*'))
-  if OS == 'linux':
-    binaries += glob(os.path.join(package_dir, 'lib', '*.so*'))
-  elif OS == 'macos':
-    binaries += glob(os.path.join(package_dir, 'lib', '*.dylib'))
-  binaries = list(filter(lambda f: os.path.isfile(f) and not os.path.islink(f), binaries))
+  binary_members = extract_package_members(package_filename, cfg.build_dir, is_package_binary)
+  binaries = [os.path.join(cfg.build_dir, name) for name in binary_members]
 
   # Check the symbols in the binaries
   if OS == 'linux':
@@ -243,23 +319,27 @@ if cfg.target == 'package':
   sign_tool = None
   if OS == 'windows':
     sign_tool = os.environ.get('SIGN_FILE_WINDOWS')
-    sign_tool_cmd = f'{sign_tool} -q -vv'
   elif OS == 'macos':
     sign_tool = os.environ.get('MACOS_SIGNING_SCRIPT')
-    sign_tool_cmd = sign_tool
-  if sign_tool:
-    for filename in binaries:
-      run(f'{sign_tool_cmd} {filename}')
+  if sign_tool and binaries:
+    sign_tool_cmd = split_command(sign_tool)
+    if OS == 'windows':
+      sign_tool_cmd += ['-q', '-vv']
+    # Signing is mostly waiting for the timestamp server, so sign concurrently
+    # Wait for all binaries to be processed before reporting any failure
+    with ThreadPoolExecutor(max_workers=min(8, len(binaries))) as executor:
+      sign_futures = [executor.submit(run, sign_tool_cmd + [filename]) for filename in binaries]
+    for future in sign_futures:
+      future.result()
 
   # Make the binaries consistently executable
   if OS != 'windows':
     for filename in binaries:
-      run(f'chmod +x {filename}')
+      os.chmod(filename, os.stat(filename).st_mode | 0o111)
 
-  # Repack
+  # Repack with the updated binaries
   if sign_tool or OS != 'windows':
-    os.remove(package_filename)
-    create_package(package_filename, package_dir)
+    update_package(package_filename, cfg.build_dir, binary_members, compresslevel=1)
 
-  # Delete the extracted package
-  shutil.rmtree(package_dir)
\ No newline at end of file
+  # Delete the extracted binaries
+  shutil.rmtree(package_dir, ignore_errors=True)
\ No newline at end of file
@@ -3,6 +3,7 @@
 ## Copyright 2020 Intel Corporation
 ## SPDX-License-Identifier: Apache-2.0
 
+import sys
 import argparse
 from common import *
 
@@ -28,5 +29,5 @@ export_cmd = os.path.join(root_dir, 'training', 'export.py')
 # Export the weights blobs
 for model in MODELS:
   tza_filename = os.path.join(weights_dir, model + '.tza')
-  run(export_cmd + f' -R {cfg.results_dir} -r {model} -o {tza_filename}')
+  run([sys.executable, export_cmd, '-R', cfg.results_dir, '-r', model, '-o', tza_filename])
   print()
\ No newline at end of file
@@ -6,43 +6,192 @@ import platform
 import subprocess
 import re
 import shutil
+import shlex
 import tarfile
-from zipfile import ZipFile
-from urllib.request import urlretrieve
+import tempfile
+import time
+from contextlib import contextmanager
+from zipfile import ZipFile, ZIP_DEFLATED
+from urllib.request import urlopen
+from urllib.error import HTTPError
 
-# Runs a command and checks the return value for success
-def run(command):
-  status = os.system(command)
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60 # seconds
+COPY_BUFSIZE = 1024 * 1024 # for copying file contents
+
+TAR_PACKAGE_RE = re.compile(r'(\.tar(\..+)?|tgz)$')
+
+# Runs a command given as a list of arguments without a shell and checks the
+# return value for success
+def run(args, **kwargs):
+  status = subprocess.run(args, **kwargs).returncode
   if status != 0:
     print('Error: non-zero return value')
     exit(1)
 
+# Splits a command line string into a list of arguments like the shell would
+def split_command(command):
+  if OS != 'windows':
+    return shlex.split(command)
+  # Backslashes are path separators on Windows, so split without escapes and
+  # only remove the surrounding quotes
+  return [arg[1:-1] if len(arg) >= 2 and arg[0] == arg[-1] == '"' else arg
+          for arg in shlex.split(command, posix=False)]
+
+# Downloads a file, reusing a previously downloaded copy if it exists
+# Only complete downloads are kept, so an existing file is never partial
 def download_file(url, output_dir):
-  print('Downloading file:', url)
   filename = os.path.join(output_dir, os.path.basename(url))
-  urlretrieve(url, filename=filename)
+  if os.path.isfile(filename):
+    print('Using cached file:', filename)
+    return filename
+  print('Downloading file:', url)
+  os.makedirs(output_dir, exist_ok=True) # may be called concurrently
+  # Download to a temporary file first to avoid caching partial downloads
+  temp_filename = filename + '.part'
+  for retry in range(DOWNLOAD_RETRIES + 1):
+    try:
+      with urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response, open(temp_filename, 'wb') as f:
+        shutil.copyfileobj(response, f, length=COPY_BUFSIZE)
+      break
+    except OSError as e: # includes URLError, timeouts and connection errors
+      # Client errors (e.g. 404) are permanent, retry only transient errors
+      if retry == DOWNLOAD_RETRIES or (isinstance(e, HTTPError) and 400 <= e.code < 500):
+        raise
+      print(f'Download failed ({e}), retrying...')
+      time.sleep(0.5 * 2**retry)
+  os.replace(temp_filename, filename)
   return filename
 
+# Moves the contents of a directory into another, merging existing subdirectories
+def merge_dir(src_dir, dst_dir):
+  if not os.path.isdir(dst_dir):
+    os.replace(src_dir, dst_dir)
+    return
+  for name in os.listdir(src_dir):
+    src = os.path.join(src_dir, name)
+    dst = os.path.join(dst_dir, name)
+    if os.path.isdir(src) and not os.path.islink(src) and os.path.isdir(dst) and not os.path.islink(dst):
+      merge_dir(src, dst)
+    else:
+      os.replace(src, dst)
+  os.rmdir(src_dir)
+
+# Opens a tar package for reading as a stream, decompressing gzip packages with
+# the multithreaded pigz if available
+@contextmanager
+def open_tar_package(filename):
+  pigz = shutil.which('pigz') if filename.endswith(('.tar.gz', '.tgz')) else None
+  if not pigz:
+    with tarfile.open(filename, 'r|*', copybufsize=COPY_BUFSIZE) as package:
+      yield package
+    return
+  with subprocess.Popen([pigz, '-dc', filename], stdout=subprocess.PIPE) as pigz_proc:
+    try:
+      with tarfile.open(fileobj=pigz_proc.stdout, mode='r|', copybufsize=COPY_BUFSIZE) as package:
+        yield package
+      # Consume the trailing padding to let pigz finish successfully
+      while pigz_proc.stdout.read(COPY_BUFSIZE):
+        pass
+    except BaseException:
+      pigz_proc.kill()
+      raise
+  if pigz_proc.returncode != 0:
+    raise Exception('failed to decompress package %s' % os.path.basename(filename))
+
 def extract_package(filename, output_dir):
   print('Extracting package:', filename)
-  # Detect the package format and open the package
-  if re.search(r'(\.tar(\..+)?|tgz)$', filename):
-    package = tarfile.open(filename)
-    members = package.getnames()
+  output_dir = os.path.abspath(output_dir)
+  output_name = os.path.basename(output_dir)
+  parent_dir = os.path.dirname(output_dir)
+  if not os.path.isdir(parent_dir):
+    os.makedirs(parent_dir)
+  # Detect the package format and extract the package
+  if TAR_PACKAGE_RE.search(filename):
+    # Stream the package to decompress it only once, extracting it into a
+    # temporary directory as the common path is known only at the end
+    temp_dir = tempfile.mkdtemp(prefix='.extract-', dir=parent_dir)
+    extract_dir = os.path.join(temp_dir, 'package') # created with the default permissions
+    try:
+      os.mkdir(extract_dir)
+      with open_tar_package(filename) as package:
+        # Extract only plain data without restoring the owners if supported
+        if hasattr(tarfile, 'data_filter'):
+          package.extraction_filter = tarfile.data_filter
+        common_path = None
+        for member in package:
+          common_path = member.name if common_path is None else os.path.commonpath([common_path, member.name])
+          package.extract(member, extract_dir)
+      # Avoid nesting two top-level directories with the same name
+      if common_path == output_name:
+        merge_dir(os.path.join(extract_dir, output_name), output_dir)
+      else:
+        merge_dir(extract_dir, output_dir)
+    finally:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+  elif filename.endswith('.zip'):
+    with ZipFile(filename) as package:
+      # Avoid nesting two top-level directories with the same name
+      if os.path.commonpath(package.namelist()) == output_name:
+        output_dir = parent_dir
+      # Create the output directory if it doesn't exist
+      if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+      package.extractall(output_dir)
+  else:
+    raise Exception('unsupported package format')
+
+# Extracts only the regular files from a package whose names match a predicate,
+# without extracting the whole package, and returns their names
+def extract_package_members(filename, output_dir, predicate):
+  print('Extracting package members:', filename)
+  names = []
+  if TAR_PACKAGE_RE.search(filename):
+    with open_tar_package(filename) as package:
+      if hasattr(tarfile, 'data_filter'):
+        package.extraction_filter = tarfile.data_filter
+      for member in package:
+        if member.isreg() and predicate(member.name):
+          package.extract(member, output_dir)
+          names.append(member.name)
+  elif filename.endswith('.zip'):
+    with ZipFile(filename) as package:
+      for info in package.infolist():
+        if not info.is_dir() and predicate(info.filename):
+          package.extract(info, output_dir)
+          names.append(info.filename)
+  else:
+    raise Exception('unsupported package format')
+  return names
+
+# Rewrites a package, replacing the given members with the files with the same
+# relative path in a directory and copying all other members unchanged
+def update_package(filename, input_dir, names, compresslevel=None):
+  print('Updating package:', filename)
+  names = set(names)
+  temp_filename = filename + '.tmp'
+  if filename.endswith('.tar.gz'):
+    tar_kwargs = {} if compresslevel is None else {'compresslevel' : compresslevel}
+    with open_tar_package(filename) as src_package, \
+         tarfile.open(temp_filename, 'w:gz', copybufsize=COPY_BUFSIZE, **tar_kwargs) as package:
+      for member in src_package:
+        if member.name in names:
+          path = os.path.join(input_dir, member.name)
+          with open(path, 'rb') as f:
+            package.addfile(package.gettarinfo(path, arcname=member.name), f)
+        else:
+          package.addfile(member, src_package.extractfile(member) if member.isreg() else None)
   elif filename.endswith('.zip'):
-    package = ZipFile(filename)
-    members = package.namelist()
+    with ZipFile(filename) as src_package, \
+         ZipFile(temp_filename, 'w', ZIP_DEFLATED, compresslevel=compresslevel) as package:
+      for info in src_package.infolist():
+        if info.filename in names:
+          package.write(os.path.join(input_dir, info.filename), arcname=info.filename)
+        else:
+          package.writestr(info, src_package.read(info), compress_type=ZIP_DEFLATED, compresslevel=compresslevel)
   else:
     raise Exception('unsupported package format')
-  # Avoid nesting two top-level directories with the same name
-  if os.path.commonpath(members) == os.path.basename(output_dir):
-    output_dir = os.path.dirname(output_dir)
-  # Create the output directory if it doesn't exist
-  if not os.path.isdir(output_dir):
-    os.makedirs(output_dir)
-  # Extract the package
-  package.extractall(output_dir)
-  package.close()
+  os.replace(temp_filename, filename)
 
 def create_package(filename, input_dir):
   print('Creating package:', filename)
@@ -81,8 +81,8 @@ def run_test(cmd, arch='native', retry_if_status=None):
 
   # Write command and redirect output to log
   if cfg.log:
-    run(f'echo >> "{cfg.log}"')
-    run(f'echo "{cmd}" >> "{cfg.log}"')
+    with open(cfg.log, 'a') as f:
+      print(f'\n{cmd}', file=f)
     cmd += f' >> "{cfg.log}" 2>&1'
   else:
     print(f'Command: {cmd}')
@@ -95,7 +95,8 @@ def run_test(cmd, arch='native', retry_if_status=None):
     retry_count = 1
     while status != 0 and retry_if_status(status) and retry_count <= 2:
       if cfg.log:
-        run(f'echo "Retrying ({retry_count})..." >> "{cfg.log}"')
+        with open(cfg.log, 'a') as f:
+          print(f'Retrying ({retry_count})...', file=f)
       status = subprocess.call(cmd, shell=True)
       retry_count += 1
 